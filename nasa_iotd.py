@@ -7,14 +7,20 @@ Usage :
 """
 
 import os
+import sys
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from bs4 import BeautifulSoup, SoupStrainer
 import argparse
 import ctypes
 from PIL import Image
 from io import BytesIO
-from datetime import datetime
+from datetime import date, datetime
+from urllib.parse import urlparse
 import tempfile
+import shutil
+import hashlib
+import json
 
 # ---------------------------------------------------------
 # CONSTANTES
@@ -22,13 +28,25 @@ import tempfile
 NASA_URL = "https://www.nasa.gov/image-of-the-day/"
 MAX_WIDTH = 3840
 MAX_HEIGHT = 2160
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+JPEG_QUALITY = 92
+LOG_COPY_CHUNK_SIZE = 64 * 1024
+# Formats SystemParametersInfoW accepts directly (Windows 7+)
+WALLPAPER_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp")
+# sha256 -> {"filename", "url"} of the images already saved in the save dir
+INDEX_FILENAME = ".index.json"
 
 # Emplacements par défaut portables (dans AppData)
 DEFAULT_BASE_DIR = os.path.join(os.environ.get("LOCALAPPDATA", os.getcwd()), "nasa_iotd")
 DEFAULT_SAVE_DIR = os.path.join(DEFAULT_BASE_DIR, "images")
 DEFAULT_LOG_FILE = DEFAULT_BASE_DIR
+# Image of the Day changes at most once a day: {"date": ..., "url": ...}
+URL_CACHE_FILE = os.path.join(DEFAULT_BASE_DIR, ".iotd_cache.json")
 
-os.makedirs(DEFAULT_SAVE_DIR, exist_ok=True)
+# Shared HTTP session (keep-alive between the page fetch and the image fetch)
+_SESSION = requests.Session()
+_SESSION.headers.update({"User-Agent": "NASA-IOTD/1.0 (+https://github.com/Kylian-MB/NASA_iotdBG)"})
+_SESSION.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=4))
 
 # Temp log buffer
 current_execution_logs = []
@@ -38,77 +56,208 @@ current_execution_logs = []
 # ---------------------------------------------------------
 def log(msg):
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    line = f"[{timestamp}] {msg}\n"
-    print(line, end="")
-    current_execution_logs.append(line)
+    current_execution_logs.append(f"[{timestamp}] {msg}\n")
+
+
+def flush_logs_to_stdout():
+    # Single write at the end of the run instead of one print per line.
+    # sys.stdout is None in the windowed (console=False) executable.
+    # Best effort: the console echo must never fail the run.
+    if sys.stdout is None:
+        return
+    text = "".join(current_execution_logs)
+    try:
+        try:
+            sys.stdout.write(text)
+        except UnicodeEncodeError:
+            # Redirected stdout on Windows is cp1252: replace what it cannot encode
+            sys.stdout.buffer.write(text.encode(sys.stdout.encoding, errors="replace"))
+        sys.stdout.flush()
+    except (OSError, AttributeError):
+        pass
 
 
 def flush_logs_to_file(log_dir):
     os.makedirs(log_dir, exist_ok=True)
     log_file = os.path.join(log_dir, "iotdLog.log")
 
-    new_block = "".join(current_execution_logs)
-    old_logs = ""
-    if os.path.exists(log_file):
-        with open(log_file, "r", encoding="utf-8") as f:
-            old_logs = f.read()
+    tmp_file = log_file + ".tmp"
+    # Binary mode: the old log is copied byte for byte, so keep the platform
+    # line endings the text-mode writes used to produce.
+    new_block = ("".join(current_execution_logs) + "\n").replace("\n", os.linesep)
 
-    with open(log_file, "w", encoding="utf-8") as f:
-        f.write(new_block + "\n" + old_logs)
+    # Newest run first: write the new block, then stream the old log after it
+    # in chunks instead of loading the whole history in memory. The finished
+    # file replaces the old one atomically, so a crash never truncates history.
+    try:
+        with open(tmp_file, "wb") as dst:
+            dst.write(new_block.encode("utf-8"))
+            if os.path.exists(log_file):
+                with open(log_file, "rb") as src:
+                    shutil.copyfileobj(src, dst, LOG_COPY_CHUNK_SIZE)
+            dst.flush()
+            os.fsync(dst.fileno())
+        os.replace(tmp_file, log_file)
+    except OSError:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
 
 
 # ---------------------------------------------------------
 # IMAGE PROCESSING
 # ---------------------------------------------------------
 def resize_image_if_needed(img_bytes):
+    """Return (image, original bytes), or (resized image, None) when a re-encode is needed."""
     img = Image.open(BytesIO(img_bytes))
     width, height = img.size
 
     if width <= MAX_WIDTH and height <= MAX_HEIGHT:
         log(f"Image already correct ({width}x{height}), no reduction.")
-        return img_bytes
+        return img, img_bytes
 
     log(f"4K Reduction : {width}x{height} → max {MAX_WIDTH}x{MAX_HEIGHT}")
-    img.thumbnail((MAX_WIDTH, MAX_HEIGHT), Image.LANCZOS)
-    new_size = img.size
+    scale = min(MAX_WIDTH / width, MAX_HEIGHT / height)
+    new_size = (max(1, round(width * scale)), max(1, round(height * scale)))
+
+    # JPEG only: let libjpeg decode at 1/2, 1/4 or 1/8 scale (never below new_size)
+    img_format = img.format
+    img.draft("RGB", new_size)
+    img = img.resize(new_size, Image.LANCZOS, reducing_gap=3.0)
+    # resize() drops the format, save_img needs it to re-encode
+    img.format = img_format
     log(f"New size : {new_size[0]}x{new_size[1]}")
+    return img, None
+
 
-    output = BytesIO()
-    img.save(output, format=img.format or "JPEG")
-    return output.getvalue()
+def filename_from_url(url):
+    # Path only: query strings (cache busters) and fragments are dropped
+    return os.path.basename(urlparse(url).path)
 
 
-def save_img(img_bytes, url, save_dir):
+def save_img(img, img_bytes, url, save_dir, filename=None):
     os.makedirs(save_dir, exist_ok=True)
-    filename = url.split('/')[-1]
+    filename = filename or filename_from_url(url)
     save_path = os.path.join(save_dir, filename)
-    with open(save_path, "wb") as f:
-        f.write(img_bytes)
+    if img_bytes is not None:
+        # Untouched download: write it as is, no re-encode
+        with open(save_path, "wb") as f:
+            f.write(img_bytes)
+    else:
+        # Resized image: single encode, in the source format
+        img_format = img.format or "JPEG"
+        if img_format == "JPEG" and img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        img.save(save_path, format=img_format, quality=JPEG_QUALITY)
     log(f"Image saved : {save_path}")
     return save_path
 
 
+# ---------------------------------------------------------
+# IMAGE INDEX
+# ---------------------------------------------------------
+def load_image_index(save_dir):
+    try:
+        with open(os.path.join(save_dir, INDEX_FILENAME), "r", encoding="utf-8") as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(index, dict):
+        return {}
+    return {digest: entry for digest, entry in index.items()
+            if isinstance(entry, dict)
+            and isinstance(entry.get("filename"), str)
+            and isinstance(entry.get("url"), str)}
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def save_image_index(save_dir, index):
+    # Forget images that were deleted since (cleanup or by hand)
+    index = {digest: entry for digest, entry in index.items()
+             if os.path.exists(os.path.join(save_dir, entry["filename"]))}
+    index_file = os.path.join(save_dir, INDEX_FILENAME)
+    tmp_file = index_file + ".tmp"
+
+    # Atomic replace: a torn write must never leave an empty index behind
+    try:
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(index, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, index_file)
+    except OSError:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+
+
 # ---------------------------------------------------------
 # WALLPAPER
 # ---------------------------------------------------------
-def set_wallpaper(img_bytes):
+def set_wallpaper(img_path):
     log("Applying the wallpaper...")
-    img = Image.open(BytesIO(img_bytes)).convert("RGB")
-    bmp_path = os.path.join(tempfile.gettempdir(), "iotd_wallpaper.bmp")
-    img.save(bmp_path, "BMP")
-    ctypes.windll.user32.SystemParametersInfoW(20, 0, bmp_path, 3)
+    wallpaper_path = os.path.abspath(img_path)
+    if not wallpaper_path.lower().endswith(WALLPAPER_EXTENSIONS):
+        # Fallback for other formats: convert to BMP
+        wallpaper_path = os.path.join(tempfile.gettempdir(), "iotd_wallpaper.bmp")
+        with Image.open(img_path) as img:
+            img.convert("RGB").save(wallpaper_path, "BMP")
+    ctypes.windll.user32.SystemParametersInfoW(20, 0, wallpaper_path, 3)
     log("Wallpaper applied.")
 
 
 # ---------------------------------------------------------
 # NETWORK & PARSING
 # ---------------------------------------------------------
+def load_cached_image_url():
+    try:
+        with open(URL_CACHE_FILE, "r", encoding="utf-8") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(cache, dict) or cache.get("date") != date.today().isoformat():
+        return None
+    url = cache.get("url")
+    return url if isinstance(url, str) else None
+
+
+def save_cached_image_url(url):
+    try:
+        os.makedirs(os.path.dirname(URL_CACHE_FILE), exist_ok=True)
+        with open(URL_CACHE_FILE, "w", encoding="utf-8") as f:
+            json.dump({"date": date.today().isoformat(), "url": url}, f)
+    except OSError as e:
+        log(f"Could not write the URL cache : {e}")
+
+
+def clear_cached_image_url():
+    try:
+        os.remove(URL_CACHE_FILE)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        log(f"Could not remove the URL cache : {e}")
+
+
 def get_latest_image_url():
+    cached_url = load_cached_image_url()
+    if cached_url:
+        log(f"Image URL from today's cache : {cached_url}")
+        return cached_url
+
     log("Retrieving the NASA page...")
-    html = requests.get(NASA_URL).text
-    soup = BeautifulSoup(html, "html.parser")
+    html = _SESSION.get(NASA_URL, timeout=10).text
+    # Only build the <article> subtrees, the rest of the page is never used
+    soup = BeautifulSoup(html, "lxml", parse_only=SoupStrainer("article"))
 
-    img = soup.select_one("article img")
+    img = soup.find("img", src=True)
     if not img:
         raise Exception("The image could not be found on the NASA page.")
 
@@ -119,13 +268,22 @@ def get_latest_image_url():
         src = "https://www.nasa.gov" + src
 
     log(f"Image URL detected : {src}")
+    save_cached_image_url(src)
     return src
 
 
 def download_img(url):
+    """Return the downloaded bytes and their SHA-256 hex digest."""
     log(f"Downloading the image...")
-    img_data = requests.get(url).content
-    return resize_image_if_needed(img_data)
+    # Stream into a single buffer instead of building response.content from chunks
+    buffer = BytesIO()
+    digest = hashlib.sha256()
+    with _SESSION.get(url, stream=True, timeout=30) as response:
+        response.raise_for_status()
+        for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+            buffer.write(chunk)
+            digest.update(chunk)
+    return buffer.getvalue(), digest.hexdigest()
 
 
 # ---------------------------------------------------------
@@ -135,13 +293,16 @@ def cleanup_old_images(save_dir, keep_history, keep_filename):
     if keep_history:
         return
 
-    for file in os.listdir(save_dir):
-        if file != keep_filename:
-            try:
-                os.remove(os.path.join(save_dir, file))
-                log(f"Old image deleted: {file}")
-            except Exception as e:
-                log(f"Error deletion {file} : {e}")
+    with os.scandir(save_dir) as entries:
+        for entry in entries:
+            if entry.name in (keep_filename, INDEX_FILENAME):
+                continue
+            if entry.is_file(follow_symlinks=False):
+                try:
+                    os.remove(entry.path)
+                    log(f"Old image deleted: {entry.name}")
+                except Exception as e:
+                    log(f"Error deletion {entry.name} : {e}")
 
 
 # ---------------------------------------------------------
@@ -163,18 +324,49 @@ def main():
     keep_history = args.keep_history
 
     try:
+        os.makedirs(save_dir, exist_ok=True)
         img_url = get_latest_image_url()
-        filename = img_url.split('/')[-1]
-        save_path = os.path.join(save_dir, filename)
+        filename = filename_from_url(img_url)
 
-        if not os.path.exists(save_path):
-            img_bytes = download_img(img_url)
-            save_img(img_bytes, img_url, save_dir)
-            set_wallpaper(img_bytes)
-        else:
+        # The index, not the basename, decides whether this URL was already saved
+        index = load_image_index(save_dir)
+        url_filenames = {entry["url"]: entry["filename"] for entry in index.values()}
+        known_filename = url_filenames.get(img_url)
+
+        if known_filename and os.path.exists(os.path.join(save_dir, known_filename)):
+            filename = known_filename
             log(f"Already existing image: {filename}")
-            with open(save_path, "rb") as f:
-                set_wallpaper(f.read())
+        else:
+            try:
+                img_bytes, digest = download_img(img_url)
+            except Exception:
+                # Don't keep a broken URL for the rest of the day: next run re-reads the page
+                clear_cached_image_url()
+                raise
+            entry = index.get(digest)
+
+            if entry and os.path.exists(os.path.join(save_dir, entry["filename"])):
+                # Same content republished under another URL
+                filename = entry["filename"]
+                log(f"Same image already saved as: {filename}")
+            else:
+                existing_path = os.path.join(save_dir, filename)
+                if (os.path.exists(existing_path)
+                        and os.path.getsize(existing_path) == len(img_bytes)
+                        and file_sha256(existing_path) == digest):
+                    # Same image saved before the index existed (or the index was lost)
+                    log(f"Already existing image: {filename}")
+                else:
+                    if os.path.exists(existing_path):
+                        # Basename reused by a different image: keep both
+                        filename = f"{digest[:12]}_{filename}"
+                    img, img_bytes = resize_image_if_needed(img_bytes)
+                    save_img(img, img_bytes, img_url, save_dir, filename)
+
+            index[digest] = {"filename": filename, "url": img_url}
+            save_image_index(save_dir, index)
+
+        set_wallpaper(os.path.join(save_dir, filename))
 
         cleanup_old_images(save_dir, keep_history, filename)
 
@@ -183,7 +375,12 @@ def main():
 
     finally:
         log("---- End of execution ----")
-        flush_logs_to_file(log_file_dir)
+        # File first so the console echo cannot cost the log, but always echo
+        # since log() no longer prints live.
+        try:
+            flush_logs_to_file(log_file_dir)
+        finally:
+            flush_logs_to_stdout()
 
 
 if __name__ == "__main__":
@@ -1,6 +1,10 @@
+import hashlib
+import io
+import json
 import os
 import sys
 import types
+from datetime import date
 from io import BytesIO
 
 import pytest
@@ -22,6 +26,12 @@ def make_image_bytes(w, h, fmt="JPEG", color=(255, 0, 0)):
     return buf.getvalue()
 
 
+@pytest.fixture(autouse=True)
+def isolated_url_cache(monkeypatch, tmp_path):
+    # Keep the daily URL cache out of the real AppData folder
+    monkeypatch.setattr(app, "URL_CACHE_FILE", str(tmp_path / ".iotd_cache.json"))
+
+
 @pytest.mark.parametrize(
     "src, expected",
     [
@@ -39,28 +49,129 @@ def test_get_latest_image_url_parsing(monkeypatch, src, expected):
     </body></html>
     """
 
-    def fake_get(_):
+    def fake_get(_, **kwargs):
         return DummyResp(text=html)
 
-    monkeypatch.setattr(app.requests, "get", fake_get)
+    monkeypatch.setattr(app._SESSION, "get", fake_get)
     url = app.get_latest_image_url()
     assert url == expected
 
 
+def test_get_latest_image_url_ignores_images_outside_article(monkeypatch):
+    html = """
+    <html><body>
+      <header><img src="/logo.png" /></header>
+      <article>
+        <img alt="placeholder" />
+        <img src="/images/foo.jpg" />
+      </article>
+    </body></html>
+    """
+
+    monkeypatch.setattr(app._SESSION, "get", lambda _, **kwargs: DummyResp(text=html))
+    assert app.get_latest_image_url() == "https://www.nasa.gov/images/foo.jpg"
+
+
+def test_get_latest_image_url_uses_todays_cache(monkeypatch):
+    html = '<article><img src="/images/foo.jpg" /></article>'
+    monkeypatch.setattr(app._SESSION, "get", lambda _, **kwargs: DummyResp(text=html))
+    assert app.get_latest_image_url() == "https://www.nasa.gov/images/foo.jpg"
+
+    def no_network(*args, **kwargs):
+        raise AssertionError("the NASA page should not be fetched again today")
+
+    monkeypatch.setattr(app._SESSION, "get", no_network)
+    assert app.get_latest_image_url() == "https://www.nasa.gov/images/foo.jpg"
+
+
+def test_get_latest_image_url_ignores_invalid_cached_url(monkeypatch):
+    with open(app.URL_CACHE_FILE, "w", encoding="utf-8") as f:
+        json.dump({"date": date.today().isoformat(), "url": 42}, f)
+
+    html = '<article><img src="/images/foo.jpg" /></article>'
+    monkeypatch.setattr(app._SESSION, "get", lambda _, **kwargs: DummyResp(text=html))
+    assert app.get_latest_image_url() == "https://www.nasa.gov/images/foo.jpg"
+
+
+def test_main_drops_url_cache_when_download_fails(monkeypatch, tmp_path):
+    with open(app.URL_CACHE_FILE, "w", encoding="utf-8") as f:
+        json.dump({"date": date.today().isoformat(), "url": "https://www.nasa.gov/images/gone.jpg"}, f)
+
+    def fail(url):
+        raise Exception("404 Client Error")
+
+    monkeypatch.setattr(app, "download_img", fail)
+    monkeypatch.setattr(sys, "argv", ["prog", "--save-dir", str(tmp_path / "images"), "--log-file", str(tmp_path)])
+
+    app.main()
+
+    assert not os.path.exists(app.URL_CACHE_FILE)
+
+
 def test_resize_image_if_needed_downsizes_large_images():
     # Create a very large image
     big_bytes = make_image_bytes(8000, 5000)
-    out_bytes = app.resize_image_if_needed(big_bytes)
-    out_img = Image.open(BytesIO(out_bytes))
+    out_img, out_bytes = app.resize_image_if_needed(big_bytes)
+    # Resized images have to be re-encoded by save_img
+    assert out_bytes is None
     w, h = out_img.size
     assert w <= app.MAX_WIDTH and h <= app.MAX_HEIGHT
 
 
 def test_resize_image_if_needed_keeps_small_images():
     small_bytes = make_image_bytes(1920, 1080)
-    out_bytes = app.resize_image_if_needed(small_bytes)
+    out_img, out_bytes = app.resize_image_if_needed(small_bytes)
     # Should be unchanged
     assert out_bytes == small_bytes
+    assert out_img.size == (1920, 1080)
+
+
+@pytest.mark.parametrize(
+    "url",
+    [
+        "https://www.nasa.gov/images/foo.jpg",
+        "https://www.nasa.gov/images/foo.jpg?cache_bust=123",
+        "https://www.nasa.gov/images/foo.jpg#top",
+    ],
+)
+def test_filename_from_url_strips_query_and_fragment(url):
+    assert app.filename_from_url(url) == "foo.jpg"
+
+
+def test_save_img_writes_original_bytes_or_reencodes(tmp_path):
+    small_bytes = make_image_bytes(640, 480)
+    img = Image.open(BytesIO(small_bytes))
+
+    path = app.save_img(img, small_bytes, "https://www.nasa.gov/images/a.jpg", str(tmp_path))
+    assert path == str(tmp_path / "a.jpg")
+    assert (tmp_path / "a.jpg").read_bytes() == small_bytes
+
+    path = app.save_img(img, None, "https://www.nasa.gov/images/b.jpg", str(tmp_path))
+    with Image.open(path) as saved:
+        assert saved.format == "JPEG"
+        assert saved.size == (640, 480)
+
+
+def test_save_img_without_extension_writes_rgb_jpeg(tmp_path):
+    # Format unknown and no extension to guess from: fall back to JPEG
+    img = Image.new("RGBA", (640, 480), (255, 0, 0, 128))
+
+    path = app.save_img(img, None, "https://www.nasa.gov/images/foo", str(tmp_path))
+    with Image.open(path) as saved:
+        assert saved.format == "JPEG"
+        assert saved.mode == "RGB"
+
+
+def test_save_img_keeps_source_format_after_resize(tmp_path):
+    # Large RGBA PNG served under a .jpg name
+    buf = BytesIO()
+    Image.new("RGBA", (4000, 2500), (255, 0, 0, 128)).save(buf, "PNG")
+    img, img_bytes = app.resize_image_if_needed(buf.getvalue())
+
+    path = app.save_img(img, img_bytes, "https://www.nasa.gov/images/foo.jpg", str(tmp_path))
+    with Image.open(path) as saved:
+        assert saved.format == "PNG"
+        assert saved.size == img.size
 
 
 def test_cleanup_old_images(tmp_path):
@@ -76,18 +187,27 @@ def test_cleanup_old_images(tmp_path):
         assert not (tmp_path / name).exists()
 
 
-def test_set_wallpaper_is_called_with_bmp(monkeypatch, tmp_path):
-    # Provide a small image
-    img_bytes = make_image_bytes(640, 480)
+@pytest.mark.parametrize("content", ["not json", "[]", '"a string"'])
+def test_load_image_index_ignores_invalid_content(tmp_path, content):
+    (tmp_path / app.INDEX_FILENAME).write_text(content, encoding="utf-8")
+    assert app.load_image_index(str(tmp_path)) == {}
 
-    calls = {}
 
+def test_save_image_index_replaces_file_atomically(tmp_path):
+    (tmp_path / "foo.jpg").write_bytes(b"x")
+    index = {"abc": {"filename": "foo.jpg", "url": "https://www.nasa.gov/images/foo.jpg"}}
+
+    app.save_image_index(str(tmp_path), index)
+
+    assert app.load_image_index(str(tmp_path)) == index
+    assert not (tmp_path / (app.INDEX_FILENAME + ".tmp")).exists()
+
+
+def install_fake_windll(monkeypatch, calls):
     class FakeUser32:
         def SystemParametersInfoW(self, action, uParam, path, winIni):
-            # Check BMP path is created
             calls["args"] = (action, uParam, path, winIni)
             assert os.path.exists(path)
-            assert path.lower().endswith(".bmp")
             return 1
 
     class FakeWindll:
@@ -98,8 +218,27 @@ def test_set_wallpaper_is_called_with_bmp(monkeypatch, tmp_path):
     fake_ctypes = types.SimpleNamespace(windll=FakeWindll())
     monkeypatch.setattr(app, "ctypes", fake_ctypes)
 
-    app.set_wallpaper(img_bytes)
-    assert "args" in calls
+
+def test_set_wallpaper_uses_jpeg_path_directly(monkeypatch, tmp_path):
+    img_path = tmp_path / "foo.jpg"
+    img_path.write_bytes(make_image_bytes(640, 480))
+
+    calls = {}
+    install_fake_windll(monkeypatch, calls)
+
+    app.set_wallpaper(str(img_path))
+    assert calls["args"] == (20, 0, str(img_path), 3)
+
+
+def test_set_wallpaper_converts_other_formats_to_bmp(monkeypatch, tmp_path):
+    img_path = tmp_path / "foo.gif"
+    img_path.write_bytes(make_image_bytes(640, 480, fmt="GIF"))
+
+    calls = {}
+    install_fake_windll(monkeypatch, calls)
+
+    app.set_wallpaper(str(img_path))
+    assert calls["args"][2].lower().endswith(".bmp")
 
 
 def test_main_flow_creates_file_and_logs(monkeypatch, tmp_path):
@@ -112,8 +251,8 @@ def test_main_flow_creates_file_and_logs(monkeypatch, tmp_path):
 
     # Mock network and heavy side effects
     monkeypatch.setattr(app, "get_latest_image_url", lambda: test_url)
-    monkeypatch.setattr(app, "download_img", lambda url: test_img)
-    monkeypatch.setattr(app, "set_wallpaper", lambda data: None)
+    monkeypatch.setattr(app, "download_img", lambda url: (test_img, hashlib.sha256(test_img).hexdigest()))
+    monkeypatch.setattr(app, "set_wallpaper", lambda path: None)
 
     # Simulate CLI args
     argv = [
@@ -136,3 +275,164 @@ def test_main_flow_creates_file_and_logs(monkeypatch, tmp_path):
     log_file = log_dir / "iotdLog.log"
     assert log_file.exists()
     assert log_file.read_text("utf-8").strip() != ""
+
+
+def test_download_img_streams_response(monkeypatch):
+    img_bytes = make_image_bytes(640, 480)
+
+    class FakeStreamResp:
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            return False
+
+        def raise_for_status(self):
+            pass
+
+        def iter_content(self, chunk_size):
+            for i in range(0, len(img_bytes), chunk_size):
+                yield img_bytes[i:i + chunk_size]
+
+    def fake_get(_, **kwargs):
+        assert kwargs.get("stream") is True
+        return FakeStreamResp()
+
+    monkeypatch.setattr(app._SESSION, "get", fake_get)
+    out_bytes, digest = app.download_img("https://www.nasa.gov/images/foo.jpg")
+    assert out_bytes == img_bytes
+    assert digest == hashlib.sha256(img_bytes).hexdigest()
+
+
+def test_flush_logs_to_file_prepends_latest_run(monkeypatch, tmp_path):
+    log_file = tmp_path / "iotdLog.log"
+    log_file.write_text("old run\n", encoding="utf-8")
+
+    monkeypatch.setattr(app, "current_execution_logs", ["new run\n"])
+    app.flush_logs_to_file(str(tmp_path))
+
+    assert log_file.read_text("utf-8") == "new run\n\nold run\n"
+    assert not (tmp_path / "iotdLog.log.tmp").exists()
+
+
+def test_main_logs_error_when_save_dir_cannot_be_created(monkeypatch, tmp_path):
+    blocker = tmp_path / "not_a_dir"
+    blocker.write_bytes(b"x")
+    log_dir = tmp_path / "logs"
+
+    monkeypatch.setattr(app, "get_latest_image_url", lambda: "https://www.nasa.gov/images/test.jpg")
+    monkeypatch.setattr(sys, "argv", ["prog", "--save-dir", str(blocker / "images"), "--log-file", str(log_dir)])
+
+    app.main()
+
+    # The failure is logged and the log file is still written
+    content = (log_dir / "iotdLog.log").read_text("utf-8")
+    assert "ERROR" in content
+    assert "End of execution" in content
+
+
+def test_main_log_survives_non_utf8_stdout(monkeypatch, tmp_path):
+    log_dir = tmp_path / "logs"
+    raw_stdout = BytesIO()
+    monkeypatch.setattr(sys, "stdout", io.TextIOWrapper(raw_stdout, encoding="cp1252"))
+
+    def fail():
+        raise Exception("no network")
+
+    monkeypatch.setattr(app, "get_latest_image_url", fail)
+    monkeypatch.setattr(sys, "argv", ["prog", "--save-dir", str(tmp_path / "images"), "--log-file", str(log_dir)])
+
+    app.main()
+
+    # The "❌ ERROR" line cannot be encoded in cp1252: echoed with a replacement
+    assert "❌ ERROR : no network" in (log_dir / "iotdLog.log").read_text("utf-8")
+    assert b"? ERROR : no network" in raw_stdout.getvalue()
+
+
+def test_main_echoes_logs_when_log_file_fails(monkeypatch, tmp_path, capsys):
+    blocker = tmp_path / "not_a_dir"
+    blocker.write_bytes(b"x")
+
+    def fail():
+        raise Exception("no network")
+
+    monkeypatch.setattr(app, "get_latest_image_url", fail)
+    monkeypatch.setattr(sys, "argv", ["prog", "--save-dir", str(tmp_path / "images"), "--log-file", str(blocker / "logs")])
+
+    with pytest.raises(OSError):
+        app.main()
+
+    # The log file cannot be written, the run's output still reaches the console
+    assert "❌ ERROR : no network" in capsys.readouterr().out
+
+
+def test_main_reuses_image_with_same_content(monkeypatch, tmp_path):
+    save_dir = tmp_path / "images"
+    test_img = make_image_bytes(100, 100)
+    digest = hashlib.sha256(test_img).hexdigest()
+
+    urls = iter(["https://www.nasa.gov/images/a.jpg", "https://www.nasa.gov/images/b.jpg"])
+    wallpapers = []
+    monkeypatch.setattr(app, "get_latest_image_url", lambda: next(urls))
+    monkeypatch.setattr(app, "download_img", lambda url: (test_img, digest))
+    monkeypatch.setattr(app, "set_wallpaper", wallpapers.append)
+    monkeypatch.setattr(sys, "argv", ["prog", "--save-dir", str(save_dir), "--log-file", str(tmp_path)])
+
+    app.main()
+    app.main()
+
+    # Second URL has the same bytes: no new file, wallpaper points at a.jpg
+    assert sorted(p.name for p in save_dir.glob("*.jpg")) == ["a.jpg"]
+    assert wallpapers == [str(save_dir / "a.jpg")] * 2
+    assert (save_dir / app.INDEX_FILENAME).exists()
+
+
+def test_main_downloads_new_image_with_reused_basename(monkeypatch, tmp_path):
+    save_dir = tmp_path / "images"
+    images = {
+        "https://www.nasa.gov/2025/01/image.jpg": make_image_bytes(100, 100, color=(255, 0, 0)),
+        "https://www.nasa.gov/2025/02/image.jpg": make_image_bytes(100, 100, color=(0, 0, 255)),
+    }
+    urls = iter(list(images) + ["https://www.nasa.gov/2025/02/image.jpg"])
+    downloads = []
+    wallpapers = []
+
+    def fake_download(url):
+        downloads.append(url)
+        return images[url], hashlib.sha256(images[url]).hexdigest()
+
+    monkeypatch.setattr(app, "get_latest_image_url", lambda: next(urls))
+    monkeypatch.setattr(app, "download_img", fake_download)
+    monkeypatch.setattr(app, "set_wallpaper", wallpapers.append)
+    monkeypatch.setattr(sys, "argv", ["prog", "--save-dir", str(save_dir), "--log-file", str(tmp_path), "--keep-history"])
+
+    app.main()
+    app.main()
+    app.main()
+
+    # Same basename, new content: downloaded and saved next to the old one.
+    # Third run is the same URL again: served from the index, no download.
+    assert downloads == list(images)
+    assert len(list(save_dir.glob("*image.jpg"))) == 2
+    assert wallpapers[1] != wallpapers[0]
+    assert wallpapers[2] == wallpapers[1]
+
+
+def test_main_reuses_unindexed_file_with_same_content(monkeypatch, tmp_path):
+    save_dir = tmp_path / "images"
+    save_dir.mkdir()
+    test_img = make_image_bytes(100, 100)
+    # Saved by a version without the index
+    (save_dir / "foo.jpg").write_bytes(test_img)
+
+    wallpapers = []
+    monkeypatch.setattr(app, "get_latest_image_url", lambda: "https://www.nasa.gov/images/foo.jpg")
+    monkeypatch.setattr(app, "download_img", lambda url: (test_img, hashlib.sha256(test_img).hexdigest()))
+    monkeypatch.setattr(app, "set_wallpaper", wallpapers.append)
+    monkeypatch.setattr(sys, "argv", ["prog", "--save-dir", str(save_dir), "--log-file", str(tmp_path), "--keep-history"])
+
+    app.main()
+
+    assert [p.name for p in save_dir.glob("*.jpg")] == ["foo.jpg"]
+    assert wallpapers == [str(save_dir / "foo.jpg")]
+    assert "foo.jpg" in (save_dir / app.INDEX_FILENAME).read_text("utf-8")